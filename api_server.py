@@ -1,17 +1,22 @@
 import os
+import hmac
 import base64
 import uvicorn
 import time
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Header, Depends
 from fastapi.responses import JSONResponse, Response, RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from typing import Optional, AsyncGenerator
-from pydantic import BaseModel
+from typing import Optional, AsyncGenerator, List
+from pydantic import BaseModel, Field
 import logging
 
-from audio_agent import audio_agent
+from audio_agent import audio_agent, add_wav_header
+from metrics import metrics
+from upload_sessions import upload_sessions, UploadSessionError
+from profiler import profiler, ProfilerMiddleware
+from static_assets import StaticAssetPipeline, IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL
 
 # 配置日志
 logging.basicConfig(
@@ -39,19 +44,63 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 挂载静态文件
+# 添加性能分析中间件，默认关闭，通过管理端点在运行时开启
+app.add_middleware(ProfilerMiddleware, profiler=profiler)
+
+# 挂载静态文件（未带指纹的原始地址，保持兼容）
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+# 启动时生成带指纹和预压缩的静态资源
+static_assets = StaticAssetPipeline(directory="static")
+static_assets.build()
+
+@app.get("/assets/{asset_path:path}")
+async def get_asset(asset_path: str, request: Request):
+    """返回带指纹的静态资源，内容不变可长期缓存"""
+    asset = static_assets.get(asset_path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="资源不存在")
+    return static_assets.response(request, asset, IMMUTABLE_CACHE_CONTROL)
+
 # 添加favicon.ico路由
 @app.get("/favicon.ico")
 async def get_favicon():
     """处理favicon.ico请求"""
-    return RedirectResponse(url="/static/favicon.svg")
+    return RedirectResponse(url=static_assets.url_for("favicon.svg"))
 
 class AudioRequest(BaseModel):
     audio_data: str
     text_prompt: str = "这段音频在说什么"
     audio_format: str = "webm"  # 默认使用webm格式，前端现在发送的是wav
+    stream_format: str = "wav"  # 流式返回的音频格式：wav（带WAV头）或pcm（原始PCM）
+
+class UploadSessionRequest(BaseModel):
+    sample_rate: int = 16000  # 前端VAD输出的采样率
+    max_seconds: Optional[int] = None
+
+class UploadCommitRequest(BaseModel):
+    text_prompt: str = "这段音频在说什么"
+    total_samples: Optional[int] = None  # 客户端已上传的总采样数，用于校验完整性
+    stream_format: str = "wav"
+
+class ProfilerSampleRequest(BaseModel):
+    requests: int = 10  # 采样接下来的请求数
+    interval_ms: float = 5  # 采样间隔
+    paths: Optional[List[str]] = None  # 采样的请求路径（fnmatch模式），默认为调用模型的端点
+
+class ProfilerTraceRequest(BaseModel):
+    session_ids: List[str]
+
+# 单次回复播放统计的上限（毫秒），超出范围的上报视为无效
+MAX_PLAYBACK_MS = 10 * 60 * 1000
+
+class PlaybackMetrics(BaseModel):
+    underruns: int = Field(0, ge=0, le=10000)
+    underrun_ms: float = Field(0, ge=0, le=MAX_PLAYBACK_MS)
+    played_ms: float = Field(0, ge=0, le=MAX_PLAYBACK_MS)
+    max_buffered_ms: float = Field(0, ge=0, le=MAX_PLAYBACK_MS)
+    start_delay_ms: float = Field(0, ge=0, le=MAX_PLAYBACK_MS)
+    target_ms: float = Field(0, ge=0, le=MAX_PLAYBACK_MS)
 
 @app.post("/process_audio")
 async def process_audio(request: AudioRequest):
@@ -107,11 +156,12 @@ async def stream_audio(request: AudioRequest):
         logger.info(f"收到流式音频请求，大小: {request_size} 字节，格式: {request.audio_format}")
         
         # 解码base64音频数据
-        audio_bytes = base64.b64decode(request.audio_data)
+        with profiler.stage("decode_base64"):
+            audio_bytes = base64.b64decode(request.audio_data)
         
         # 创建响应流
         return StreamingResponse(
-            audio_agent.stream_audio(audio_bytes, request.text_prompt, request.audio_format),
+            audio_agent.stream_audio(audio_bytes, request.text_prompt, request.audio_format, request.stream_format),
             media_type="text/event-stream"
         )
         
@@ -119,6 +169,79 @@ async def stream_audio(request: AudioRequest):
         logger.error(f"流式处理音频时出错: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/upload_sessions")
+async def create_upload_session(request: UploadSessionRequest):
+    """创建增量上传会话，用户说话期间即可开始上传音频"""
+    try:
+        session = upload_sessions.create(request.sample_rate, request.max_seconds)
+        return {
+            "session_id": session.session_id,
+            "sample_rate": session.sample_rate,
+            "max_samples": session.max_samples
+        }
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+async def read_limited_body(request: Request, limit: int, too_large) -> bytes:
+    """读取请求体，超过limit字节时立即停止并抛出too_large()返回的异常"""
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            if int(content_length) > limit:
+                raise too_large()
+        except ValueError:
+            raise UploadSessionError("无效的Content-Length")
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise too_large()
+    return bytes(body)
+
+@app.post("/upload_sessions/{session_id}/chunks")
+async def upload_session_chunk(session_id: str, offset: int, request: Request):
+    """写入一段16位PCM数据，offset为起始采样偏移"""
+    try:
+        session = upload_sessions.get(session_id)
+        session.write(offset, await read_limited_body(request, session.max_chunk_bytes(offset), session.too_long_error))
+        return {"status": "success", "num_samples": session.num_samples}
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+@app.post("/upload_sessions/{session_id}/commit")
+async def commit_upload_session(session_id: str, request: UploadCommitRequest):
+    """提交上传会话，使用已上传的音频立即开始流式处理"""
+    try:
+        with profiler.stage("assemble_upload"):
+            session = upload_sessions.get(session_id)
+            pcm = session.pcm(request.total_samples)
+            upload_sessions.pop(session_id)
+        logger.info(
+            f"提交上传会话 {session_id}，{session.chunks} 个数据块，"
+            f"时长: {session.num_samples / session.sample_rate:.2f}秒"
+        )
+        
+        wav_bytes = add_wav_header(pcm, session.sample_rate)
+        return StreamingResponse(
+            audio_agent.stream_audio(wav_bytes, request.text_prompt, "wav", request.stream_format),
+            media_type="text/event-stream"
+        )
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        logger.error(f"提交上传会话时出错: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.delete("/upload_sessions/{session_id}")
+async def delete_upload_session(session_id: str):
+    """丢弃上传会话（例如VAD误触发）"""
+    try:
+        upload_sessions.pop(session_id)
+        return {"status": "success"}
+    except UploadSessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
 @app.post("/clear_history")
 async def clear_chat_history():
     """清除对话历史记录"""
@@ -129,30 +252,105 @@ async def clear_chat_history():
         logger.error(f"清除对话历史时出错: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/playback_metrics")
+async def report_playback_metrics(report: PlaybackMetrics):
+    """接收前端流式播放器上报的播放统计"""
+    metrics.incr("playback_replies")
+    metrics.incr("playback_underruns", report.underruns)
+    if report.underruns:
+        metrics.incr("playback_replies_with_underrun")
+    metrics.observe("playback_underrun_ms", report.underrun_ms)
+    metrics.observe("playback_played_ms", report.played_ms)
+    metrics.observe("playback_max_buffered_ms", report.max_buffered_ms)
+    metrics.observe("playback_start_delay_ms", report.start_delay_ms)
+    metrics.observe("playback_target_ms", report.target_ms)
+    return {"status": "success"}
+
+@app.get("/metrics")
+async def get_metrics():
+    """返回服务端和前端上报的运行指标"""
+    return metrics.snapshot()
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """校验管理令牌，未配置PROFILER_ADMIN_TOKEN时管理端点不可用"""
+    admin_token = os.environ.get("PROFILER_ADMIN_TOKEN")
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    # 按字节比较，str版本的compare_digest遇到非ASCII字符会抛出TypeError
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode("utf-8"), admin_token.encode("utf-8")):
+        raise HTTPException(status_code=403, detail="无效的管理令牌")
+
+@app.get("/admin/profiler", dependencies=[Depends(require_admin)])
+async def get_profiler_status():
+    """查看性能分析状态"""
+    return profiler.status()
+
+@app.post("/admin/profiler/sample", dependencies=[Depends(require_admin)])
+async def start_profiler_sampling(request: ProfilerSampleRequest):
+    """在接下来的N个匹配请求处理期间对事件循环进行调用栈采样"""
+    profiler.start_sampling(request.requests, request.interval_ms, request.paths)
+    logger.info(f"开启调用栈采样: {request.requests} 个请求，间隔 {request.interval_ms}ms")
+    return profiler.status()
+
+@app.post("/admin/profiler/trace", dependencies=[Depends(require_admin)])
+async def start_profiler_trace(request: ProfilerTraceRequest):
+    """为指定会话ID开启阶段计时"""
+    profiler.trace_sessions_add(request.session_ids)
+    logger.info(f"开启阶段计时: {', '.join(request.session_ids)}")
+    return profiler.status()
+
+@app.delete("/admin/profiler", dependencies=[Depends(require_admin)])
+async def stop_profiler(clear: bool = False):
+    """关闭性能分析，clear为true时同时清除已采集的数据"""
+    profiler.stop()
+    if clear:
+        profiler.clear()
+    logger.info("性能分析已关闭")
+    return profiler.status()
+
+@app.get("/admin/profiler/profile.folded", dependencies=[Depends(require_admin)])
+async def download_profile():
+    """下载折叠栈格式的采样结果，可用flamegraph.pl或speedscope查看"""
+    return Response(
+        content=profiler.folded_profile(),
+        media_type="text/plain; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="profile.folded"'}
+    )
+
+@app.get("/admin/profiler/trace.json", dependencies=[Depends(require_admin)])
+async def download_trace():
+    """下载Chrome Trace格式的阶段计时，可用chrome://tracing、Perfetto或speedscope查看"""
+    return Response(
+        content=profiler.chrome_trace(),
+        media_type="application/json",
+        headers={"Content-Disposition": 'attachment; filename="trace.json"'}
+    )
+
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
     return {"status": "healthy"}
 
 @app.get("/")
-async def redirect_to_index():
-    """重定向到前端页面"""
-    from fastapi.responses import RedirectResponse
-    return RedirectResponse(url="/static/index.html")
+async def get_index(request: Request):
+    """直接返回前端页面，避免额外的重定向"""
+    if static_assets.index is None:
+        raise HTTPException(status_code=404, detail="前端页面不存在")
+    return static_assets.response(request, static_assets.index, REVALIDATE_CACHE_CONTROL)
 
 if __name__ == "__main__":
     # 获取端口，默认为8000
     port = int(os.environ.get("PORT", 8000))
-    
+
     # 检查是否存在SSL证书和密钥
     ssl_keyfile = os.environ.get("SSL_KEYFILE", "key.pem")
     ssl_certfile = os.environ.get("SSL_CERTFILE", "cert.pem")
-    
+
     # 如果证书和密钥文件存在，则启用HTTPS
     ssl_enabled = os.path.exists(ssl_keyfile) and os.path.exists(ssl_certfile)
-    
+
     workers = min(4, os.cpu_count() or 1)  # 根据CPU核心数设置工作进程数
-    
+
     if ssl_enabled:
         logger.info(f"使用HTTPS启动服务，证书: {ssl_certfile}, 密钥: {ssl_keyfile}")
         # 在以下情况下不使用多工作进程
@@ -4,11 +4,15 @@ import struct
 import time
 import json
 import asyncio
+import threading
 from agno.agent import Agent
 from openai import OpenAI
 from typing import Dict, Any, AsyncGenerator, List, Union, Optional
 from io import BytesIO  # 添加BytesIO导入
 
+from metrics import metrics
+from profiler import profiler
+
 # 配置OpenAI客户端
 def get_openai_client():
     return OpenAI(
@@ -25,10 +29,13 @@ SYSTEM_PROMPT = """# 角色设定
 风格:语气沉稳专业，不要有AI语气、模拟真人自然对话。
 """
 
+# 模型输出音频的采样率
+OUTPUT_SAMPLE_RATE = 24000
+
 # 预缓存常用采样率的WAV头
 WAV_HEADERS = {}
 
-def generate_wav_header(sample_rate: int = 24000) -> bytes:
+def generate_wav_header(sample_rate: int = OUTPUT_SAMPLE_RATE) -> bytes:
     """生成WAV文件头"""
     # WAV文件头格式
     # RIFF header
@@ -72,7 +79,7 @@ def generate_wav_header(sample_rate: int = 24000) -> bytes:
 for sr in [24000, 16000, 44100, 48000]:
     WAV_HEADERS[sr] = generate_wav_header(sr)
 
-def add_wav_header(audio_data: bytes, sample_rate: int = 24000) -> bytes:
+def add_wav_header(audio_data: bytes, sample_rate: int = OUTPUT_SAMPLE_RATE) -> bytes:
     """添加WAV文件头，使用预缓存的头部"""
     # 如果没有预缓存当前采样率的头部，生成一个
     if sample_rate not in WAV_HEADERS:
@@ -92,6 +99,77 @@ def add_wav_header(audio_data: bytes, sample_rate: int = 24000) -> bytes:
     
     return bytes(header) + audio_data
 
+# 预先构建的紧凑JSON编码器，中文不转义为\\uXXXX，减少事件体积
+_encode_json = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+# 完成事件内容固定，预先生成
+SSE_DONE_EVENT = 'data: {"event":"done"}\n\n'
+
+def sse_event(event: str, data: Any) -> str:
+    """生成服务器发送事件"""
+    return "data: " + _encode_json({"event": event, "data": data}) + "\n\n"
+
+def sse_audio_event(event: str, b64_data: str, sample_rate: Optional[int] = None) -> str:
+    """生成音频事件，base64字符串无需转义，直接拼接"""
+    if sample_rate is None:
+        return 'data: {"event":"' + event + '","data":"' + b64_data + '"}\n\n'
+    return 'data: {"event":"' + event + '","data":"' + b64_data + '","sample_rate":' + str(sample_rate) + '}\n\n'
+
+# 模型响应流结束的标记
+_STREAM_OPENED = object()
+_STREAM_END = object()
+
+class _StreamError:
+    """后台线程读取模型响应流时发生的异常"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+def _start_stream_reader(open_stream, stop: threading.Event, cpu_stats: Dict[str, Optional[float]]) -> asyncio.Queue:
+    """在后台线程中发起模型请求并读取同步的响应流，数据块放入异步队列
+    
+    事件循环既不阻塞在等待响应头上，也不阻塞在网络读取上，可以按合并窗口的
+    截止时间发送缓存的增量。收到响应头后放入_STREAM_OPENED，最后放入
+    _STREAM_END，或者放入_StreamError表示请求或读取失败。
+    线程结束前把CPU时间写入cpu_stats["reader"]。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+    
+    def reader():
+        error = None
+        try:
+            completion = open_stream()
+            put(_STREAM_OPENED)
+            try:
+                for chunk in completion:
+                    if stop.is_set():
+                        break
+                    put(chunk)
+            finally:
+                if stop.is_set() and hasattr(completion, "close"):
+                    # 客户端已断开，关闭与模型的连接
+                    try:
+                        completion.close()
+                    except Exception:
+                        pass
+        except Exception as e:
+            error = e
+        finally:
+            # 先写入CPU时间再通知结束，事件循环收到结束标记时统计已完整
+            cpu_stats["reader"] = time.thread_time()
+            put(_StreamError(error) if error is not None else _STREAM_END)
+    
+    threading.Thread(target=reader, name="model-stream-reader", daemon=True).start()
+    return queue
+
 # 音频编码函数
 def encode_audio(audio_data):
     """将音频数据编码为base64字符串"""
@@ -111,6 +189,9 @@ class AudioProcessingAgent(Agent):
         self.max_history = 5  # 保持5轮对话历史
         # 文本长度限制
         self.max_text_length = 1000  # 每条消息最大字符数
+        # 流式事件合并窗口，设置为0时每个增量单独发送
+        self.sse_flush_interval = float(os.getenv("SSE_FLUSH_INTERVAL_MS", "40")) / 1000
+        self.sse_flush_bytes = int(os.getenv("SSE_FLUSH_BYTES", "8192"))
     
     def _prepare_messages(self, audio_data: bytes, text_prompt: str = "", audio_format: str = "webm") -> List[Dict[str, Any]]:
         """准备发送给模型的消息列表
@@ -324,34 +405,80 @@ class AudioProcessingAgent(Agent):
         self.chat_history = []
         print("对话历史已清除")
 
-    async def stream_audio(self, audio_data: bytes, text_prompt: str = "", audio_format: str = "webm") -> AsyncGenerator[str, None]:
+    async def stream_audio(self, audio_data: bytes, text_prompt: str = "", audio_format: str = "webm", stream_format: str = "wav") -> AsyncGenerator[str, None]:
         """处理音频并以流式方式返回响应（异步流式方法）
         
         Args:
             audio_data: 音频数据字节
             text_prompt: 提示文本
             audio_format: 音频格式，可以是'webm'或'wav'等
+            stream_format: 返回的音频格式，'wav'为每块带WAV头的音频，
+                'pcm'为原始16位PCM（前端AudioWorklet播放器直接使用）
         
         Yields:
             服务器发送的事件格式字符串，包含文本或音频数据
         """
+        # 统计每次回复的事件数和字节数
+        events_count = 0
+        events_bytes = 0
+        # 本次回复的CPU时间：loop为事件循环线程上处理数据块和生成事件的时间
+        # （不含等待期间其他请求占用的时间），reader为读取模型响应流的线程的时间，
+        # 读取线程结束前为None
+        cpu_stats: Dict[str, Optional[float]] = {"loop": 0.0, "reader": None}
+        try:
+            async for event in self._stream_events(audio_data, text_prompt, audio_format, stream_format, cpu_stats):
+                events_count += 1
+                events_bytes += len(event)
+                yield event
+        finally:
+            loop_cpu = cpu_stats["loop"]
+            reader_cpu = cpu_stats["reader"]
+            metrics.incr("stream_replies")
+            metrics.observe("sse_events_per_reply", events_count)
+            metrics.observe("sse_bytes_per_reply", events_bytes)
+            metrics.observe("reply_loop_cpu_ms", loop_cpu * 1000)
+            if reader_cpu is None:
+                # 客户端提前断开时读取线程可能仍在等待模型响应，CPU时间不完整，单独计数
+                metrics.incr("stream_replies_aborted")
+                print(
+                    f"回复提前结束，共发送{events_count}个事件，{events_bytes} 字节，"
+                    f"事件循环CPU耗时: {loop_cpu * 1000:.1f}毫秒"
+                )
+            else:
+                cpu_ms = (loop_cpu + reader_cpu) * 1000
+                metrics.observe("reply_cpu_ms", cpu_ms)
+                metrics.observe("reply_reader_cpu_ms", reader_cpu * 1000)
+                print(
+                    f"本次回复共发送{events_count}个事件，{events_bytes} 字节，CPU耗时: {cpu_ms:.1f}毫秒"
+                    f"（事件循环 {loop_cpu * 1000:.1f}毫秒，读取线程 {reader_cpu * 1000:.1f}毫秒）"
+                )
+
+    async def _stream_events(self, audio_data: bytes, text_prompt: str, audio_format: str, stream_format: str,
+                             cpu_stats: Dict[str, Optional[float]]) -> AsyncGenerator[str, None]:
+        """调用模型并生成合并后的服务器发送事件
+        
+        文本和音频增量先缓存起来，缓存超过sse_flush_bytes字节，或距离上次发送
+        达到sse_flush_interval时合并为一个事件发送；模型暂停输出时也会按截止时间发送。
+        第一个增量总是立即发送，不影响首包延迟。
+        """
         start_time = time.time()
         try:
             print(f"发送流式请求到模型，音频大小: {len(audio_data)} 字节，格式: {audio_format}")
             
             # 准备消息
-            messages = self._prepare_messages(audio_data, text_prompt, audio_format)
+            with profiler.stage("prepare_messages"):
+                messages = self._prepare_messages(audio_data, text_prompt, audio_format)
             
-            # 调用模型
-            model_start = time.time()
-            completion = self.client.chat.completions.create(
-                model="qwen-omni-turbo",
-                messages=messages,
-                modalities=["text", "audio"],
-                audio={"voice": "Chelsie", "format": "wav"},
-                stream=True,
-                stream_options={"include_usage": True},
-            )
+            # 调用模型，请求在读取线程中发起，等待响应头时不阻塞事件循环
+            def open_stream():
+                return self.client.chat.completions.create(
+                    model="qwen-omni-turbo",
+                    messages=messages,
+                    modalities=["text", "audio"],
+                    audio={"voice": "Chelsie", "format": "wav"},
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
             
             # 处理响应
             transcript_text = ""
@@ -359,33 +486,79 @@ class AudioProcessingAgent(Agent):
             audio_chunks_count = 0
             audio_total_size = 0
             
+            # 待合并发送的文本和音频增量
+            pending_text = []
+            pending_audio = []
+            pending_bytes = 0
+            last_flush = 0.0
+            
+            def flush():
+                """将缓存的增量合并为事件"""
+                nonlocal pending_text, pending_audio, pending_bytes, last_flush
+                events = []
+                if pending_text:
+                    events.append(sse_event("text", "".join(pending_text)))
+                if pending_audio:
+                    raw_audio = b"".join(pending_audio)
+                    if stream_format == "pcm":
+                        events.append(sse_audio_event("pcm", base64.b64encode(raw_audio).decode("ascii"), OUTPUT_SAMPLE_RATE))
+                    else:
+                        # 把原始PCM添加WAV头
+                        events.append(sse_audio_event("audio", base64.b64encode(add_wav_header(raw_audio)).decode("ascii")))
+                pending_text = []
+                pending_audio = []
+                pending_bytes = 0
+                last_flush = time.monotonic()
+                return events
+            
+            stop_reader = threading.Event()
             try:
-                for chunk in completion:
-                    # 等待一小段时间以减轻服务器压力
-                    await asyncio.sleep(0.01)
+                request_start = stream_start = time.perf_counter()
+                first_chunk = True
+                queue = _start_stream_reader(open_stream, stop_reader, cpu_stats)
+                while True:
+                    # 有缓存的增量时，最多等到合并窗口的截止时间
+                    timeout = None
+                    if pending_bytes:
+                        timeout = max(0.0, self.sse_flush_interval - (time.monotonic() - last_flush))
+                    try:
+                        chunk = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        cpu_start = time.thread_time()
+                        events = flush()
+                        cpu_stats["loop"] += time.thread_time() - cpu_start
+                        for event in events:
+                            yield event
+                        continue
+                    
+                    if chunk is _STREAM_OPENED:
+                        # 收到响应头，模型请求阶段结束
+                        profiler.record("model_request", request_start)
+                        stream_start = time.perf_counter()
+                        continue
+                    if chunk is _STREAM_END:
+                        break
+                    if isinstance(chunk, _StreamError):
+                        raise chunk.error
+                    if first_chunk:
+                        profiler.mark("model_first_chunk")
+                        first_chunk = False
                     
+                    # 处理数据块，生成的事件在计时结束后再发送
+                    cpu_start = time.thread_time()
+                    events = []
                     if chunk.choices:
                         if hasattr(chunk.choices[0].delta, "audio"):
                             try:
                                 # 获取音频数据
                                 audio_data = chunk.choices[0].delta.audio.get("data")
                                 if audio_data:
-                                    # 解码并添加WAV头
                                     try:
                                         audio_chunk = base64.b64decode(audio_data)
                                         audio_chunks_count += 1
                                         audio_total_size += len(audio_chunk)
-                                        
-                                        # 把原始PCM添加WAV头
-                                        wav_chunk = add_wav_header(audio_chunk)
-                                        # 重新编码为base64
-                                        b64_chunk = base64.b64encode(wav_chunk).decode('utf-8')
-                                        # 以服务器发送事件的格式返回
-                                        event_data = {
-                                            "event": "audio",
-                                            "data": b64_chunk
-                                        }
-                                        yield f"data: {json.dumps(event_data)}\n\n"
+                                        pending_audio.append(audio_chunk)
+                                        pending_bytes += len(audio_chunk)
                                     except Exception as e:
                                         print(f"流式处理音频数据块时出错: {e}")
                                 
@@ -398,48 +571,56 @@ class AudioProcessingAgent(Agent):
                         elif hasattr(chunk.choices[0].delta, "content"):
                             content = chunk.choices[0].delta.content
                             if content:
-                                full_text_response += str(content)
-                                # 以服务器发送事件的格式返回文本
-                                event_data = {
-                                    "event": "text",
-                                    "data": str(content)
-                                }
-                                yield f"data: {json.dumps(event_data)}\n\n"
+                                content = str(content)
+                                full_text_response += content
+                                pending_text.append(content)
+                                pending_bytes += len(content.encode("utf-8"))
+                        
+                        # 达到合并窗口或缓存大小时发送
+                        if pending_bytes and (
+                            pending_bytes >= self.sse_flush_bytes
+                            or time.monotonic() - last_flush >= self.sse_flush_interval
+                        ):
+                            events = flush()
                     elif hasattr(chunk, "usage"):
-                        # 返回用量统计
-                        event_data = {
-                            "event": "usage",
-                            "data": {
-                                "prompt_tokens": chunk.usage.prompt_tokens,
-                                "completion_tokens": chunk.usage.completion_tokens,
-                                "total_tokens": chunk.usage.total_tokens
-                            }
-                        }
-                        yield f"data: {json.dumps(event_data)}\n\n"
+                        # 先发送剩余的增量，再返回用量统计
+                        events = flush()
+                        events.append(sse_event("usage", {
+                            "prompt_tokens": chunk.usage.prompt_tokens,
+                            "completion_tokens": chunk.usage.completion_tokens,
+                            "total_tokens": chunk.usage.total_tokens
+                        }))
                         print(f"流式响应用量统计: {chunk.usage}")
+                    cpu_stats["loop"] += time.thread_time() - cpu_start
+                    
+                    for event in events:
+                        yield event
+                
+                for event in flush():
+                    yield event
+                profiler.record("model_stream", stream_start)
                 
                 # 发送完成事件
-                yield f"data: {json.dumps({'event': 'done'})}\n\n"
+                yield SSE_DONE_EVENT
                 
                 # 输出统计信息
                 print(f"共处理{audio_chunks_count}个音频数据块，总大小: {audio_total_size} 字节")
                 
             except Exception as e:
                 print(f"流式处理响应时出错: {e}")
-                # 返回错误事件
-                event_data = {
-                    "event": "error",
-                    "data": str(e)
-                }
-                yield f"data: {json.dumps(event_data)}\n\n"
+                # 错误事件由外层统一返回，避免重复发送
                 raise
+            finally:
+                # 生成器提前关闭（例如客户端断开）时通知读取线程停止
+                stop_reader.set()
             
             # 更新对话历史
             final_response_text = full_text_response if full_text_response else transcript_text
             
             # 更新对话历史 - 选择合适的信息来源
             final_user_text = transcript_text if transcript_text else text_prompt
-            self._update_chat_history(final_user_text, final_response_text, text_prompt)
+            with profiler.stage("update_history"):
+                self._update_chat_history(final_user_text, final_response_text, text_prompt)
             
             total_time = time.time() - start_time
             print(f"流式处理总时间: {total_time:.2f}秒")
@@ -447,11 +628,7 @@ class AudioProcessingAgent(Agent):
         except Exception as e:
             print(f"流式处理音频时出错: {e}")
             # 返回错误事件
-            event_data = {
-                "event": "error",
-                "data": str(e)
-            }
-            yield f"data: {json.dumps(event_data)}\n\n"
+            yield sse_event("error", str(e))
             raise
 
 # 实例化Agent
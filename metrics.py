@@ -0,0 +1,69 @@
+import threading
+from typing import Dict, Any
+
+
+class _Summary:
+    """简单的数值汇总：次数、总和、最小值、最大值"""
+
+    __slots__ = ("count", "total", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "avg": round(self.total / self.count, 3) if self.count else 0,
+            "min": self.min,
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """进程内的计数器和数值汇总，供/metrics端点导出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._summaries: Dict[str, _Summary] = {}
+
+    def incr(self, name: str, value: float = 1):
+        """累加计数器"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        """记录一次观测值"""
+        with self._lock:
+            summary = self._summaries.get(name)
+            if summary is None:
+                summary = self._summaries[name] = _Summary()
+            summary.observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回当前所有指标的快照"""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "summaries": {name: s.snapshot() for name, s in self._summaries.items()},
+            }
+
+    def reset(self):
+        """清空所有指标"""
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+
+# 全局指标实例
+metrics = Metrics()
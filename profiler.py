@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import threading
+import fnmatch
+import contextvars
+from collections import Counter
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Iterable
+
+# 默认采样的请求路径（fnmatch模式），只包含会调用模型的端点，
+# 不包含说话期间频繁上传的音频数据块
+DEFAULT_SAMPLE_PATHS = ("/stream_audio", "/process_audio", "/upload_sessions/*/commit")
+# 采样期间同时采集的后台线程（audio_agent读取模型响应流的线程）
+SAMPLED_THREAD_NAMES = ("model-stream-reader",)
+# 采样范围说明，随状态一起返回
+SAMPLE_SCOPE = (
+    "采样期间（从第一个选中的请求开始到最后一个选中的请求结束）整个事件循环线程"
+    "和所有模型响应流读取线程的调用栈，包含同时处理的其他请求，不只是选中的请求"
+)
+# 采样间隔的上下限（毫秒），避免采样开销过大
+MIN_INTERVAL_MS = 1
+MAX_INTERVAL_MS = 1000
+# 阶段计时最多保留的事件数，超出后丢弃最早的事件
+MAX_TRACE_EVENTS = 20000
+
+# 当前请求对应的阶段计时，未选中的请求为None
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("profiler_trace", default=None)
+
+# 未启用时返回的空上下文，可重复使用
+_NULL_STAGE = nullcontext()
+
+
+class _Trace:
+    """单个请求的阶段计时"""
+
+    __slots__ = ("session_id", "tid")
+
+    def __init__(self, session_id: str, tid: int):
+        self.session_id = session_id
+        self.tid = tid
+
+
+class _Stage:
+    """记录一个阶段耗时的上下文管理器"""
+
+    __slots__ = ("profiler", "trace", "name", "start")
+
+    def __init__(self, profiler: "RequestProfiler", trace: _Trace, name: str):
+        self.profiler = profiler
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._add_event(self.trace, self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _fold_stack(frame) -> str:
+    """将调用栈折叠为 外层;...;内层 的格式"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class RequestProfiler:
+    """按需启用的请求性能分析
+
+    支持两种模式，可在运行时随时开启或关闭：
+    - 采样：在接下来的N个匹配请求处理期间，定时采集事件循环线程和模型响应流
+      读取线程的调用栈，导出为折叠栈格式（flamegraph.pl、speedscope均可直接使用）。
+      事件循环线程由所有请求共享，结果包含同时处理的其他请求
+    - 阶段计时：对指定会话ID的请求记录各处理阶段的耗时，
+      导出为Chrome Trace格式（chrome://tracing、Perfetto、speedscope）
+
+    两种模式都未开启时，active为False，中间件只做一次属性判断。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = False
+        self.tracing = False
+
+        # 采样状态
+        self.sample_remaining = 0
+        self.sample_paths = DEFAULT_SAMPLE_PATHS
+        self.sample_interval = 0.005
+        self.sampled_requests = 0
+        self.samples = 0
+        self._stacks: Counter = Counter()
+        self._sampled_threads: Dict[int, int] = {}
+        self._sampler: Optional[threading.Thread] = None
+
+        # 阶段计时状态
+        self.trace_sessions: set = set()
+        self._trace_events: List[dict] = []
+        self._trace_tids: Dict[str, int] = {}
+        self._epoch = time.perf_counter()
+
+    # ---- 运行时控制 ----
+
+    def _update_active(self):
+        """调用方需持有锁"""
+        self.tracing = bool(self.trace_sessions)
+        self.active = self.sample_remaining > 0 or self.tracing
+
+    def start_sampling(self, requests: int, interval_ms: float = 5,
+                       paths: Optional[Iterable[str]] = None):
+        """在接下来的requests个匹配请求处理期间进行调用栈采样
+
+        paths为fnmatch模式，例如"/upload_sessions/*/commit"，默认为DEFAULT_SAMPLE_PATHS
+        """
+        interval_ms = max(MIN_INTERVAL_MS, min(MAX_INTERVAL_MS, interval_ms))
+        with self._lock:
+            self.sample_remaining = max(0, requests)
+            self.sample_interval = interval_ms / 1000
+            self.sample_paths = tuple(paths) if paths else DEFAULT_SAMPLE_PATHS
+            self._update_active()
+
+    def trace_sessions_add(self, session_ids: Iterable[str]):
+        """为指定会话ID开启阶段计时"""
+        with self._lock:
+            self.trace_sessions.update(sid for sid in session_ids if sid)
+            self._update_active()
+
+    def stop(self):
+        """关闭所有分析，已采集的数据保留到clear()"""
+        with self._lock:
+            self.sample_remaining = 0
+            self.trace_sessions.clear()
+            self._update_active()
+
+    def clear(self):
+        """清除已采集的数据"""
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+            self.sampled_requests = 0
+            self._trace_events.clear()
+            self._trace_tids.clear()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "active": self.active,
+                "sample_scope": SAMPLE_SCOPE,
+                "sample_remaining": self.sample_remaining,
+                "sample_interval_ms": self.sample_interval * 1000,
+                "sample_paths": list(self.sample_paths),
+                "sampled_requests": self.sampled_requests,
+                "samples": self.samples,
+                "distinct_stacks": len(self._stacks),
+                "trace_sessions": sorted(self.trace_sessions),
+                "trace_events": len(self._trace_events),
+            }
+
+    # ---- 请求处理 ----
+
+    def _claim_sample(self, path: str) -> bool:
+        """匹配的请求占用一个采样名额"""
+        if self.sample_remaining <= 0:
+            return False
+        if not any(fnmatch.fnmatchcase(path, pattern) for pattern in self.sample_paths):
+            return False
+        with self._lock:
+            if self.sample_remaining <= 0:
+                return False
+            self.sample_remaining -= 1
+            self.sampled_requests += 1
+            self._update_active()
+            return True
+
+    def _trace_for(self, scope) -> Optional[_Trace]:
+        """根据请求头X-Session-Id或上传会话路径判断是否需要阶段计时"""
+        if not self.tracing:
+            return None
+        session_id = None
+        for key, value in scope.get("headers", ()):
+            if key == b"x-session-id":
+                session_id = value.decode("latin-1")
+                break
+        if session_id not in self.trace_sessions:
+            # 上传会话的请求路径中包含会话ID
+            parts = scope.get("path", "").split("/")
+            if len(parts) > 2 and parts[1] == "upload_sessions" and parts[2] in self.trace_sessions:
+                session_id = parts[2]
+            else:
+                return None
+        with self._lock:
+            tid = self._trace_tids.setdefault(session_id, len(self._trace_tids) + 1)
+        return _Trace(session_id, tid)
+
+    async def handle(self, app, scope, receive, send):
+        """对选中的请求进行采样或阶段计时"""
+        sampled = self._claim_sample(scope.get("path", ""))
+        trace = self._trace_for(scope)
+        if not sampled and trace is None:
+            await app(scope, receive, send)
+            return
+
+        token = _current_trace.set(trace) if trace is not None else None
+        thread_id = threading.get_ident()
+        if sampled:
+            self._attach_sampler(thread_id)
+        start = time.perf_counter()
+        try:
+            await app(scope, receive, send)
+        finally:
+            if trace is not None:
+                self._add_event(trace, f"{scope.get('method', '')} {scope.get('path', '')}",
+                                start, time.perf_counter() - start)
+                _current_trace.reset(token)
+            if sampled:
+                self._detach_sampler(thread_id)
+
+    # ---- 调用栈采样 ----
+
+    def _attach_sampler(self, thread_id: int):
+        with self._lock:
+            self._sampled_threads[thread_id] = self._sampled_threads.get(thread_id, 0) + 1
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample_loop, name="request-profiler", daemon=True)
+                self._sampler.start()
+
+    def _detach_sampler(self, thread_id: int):
+        with self._lock:
+            count = self._sampled_threads.get(thread_id, 0) - 1
+            if count > 0:
+                self._sampled_threads[thread_id] = count
+            else:
+                self._sampled_threads.pop(thread_id, None)
+
+    def _sample_loop(self):
+        """采样线程：仍有请求在采样时定时采集目标线程的调用栈
+
+        事件循环线程由所有请求共享，采集到的调用栈包含同时处理的其他请求。
+        调用栈以线程名开头，便于在火焰图中区分事件循环和模型响应流读取线程。
+        """
+        while True:
+            with self._lock:
+                if not self._sampled_threads:
+                    self._sampler = None
+                    return
+                thread_ids = list(self._sampled_threads)
+                interval = self.sample_interval
+            names = {t.ident: t.name for t in threading.enumerate()}
+            thread_ids += [tid for tid, name in names.items()
+                           if name in SAMPLED_THREAD_NAMES and tid not in thread_ids]
+            frames = sys._current_frames()
+            stacks = [f"{names.get(tid, tid)};{_fold_stack(frames[tid])}" for tid in thread_ids if tid in frames]
+            del frames
+            with self._lock:
+                for stack in stacks:
+                    self._stacks[stack] += 1
+                self.samples += len(stacks)
+            time.sleep(interval)
+
+    def folded_profile(self) -> str:
+        """导出折叠栈格式的采样结果"""
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    # ---- 阶段计时 ----
+
+    def stage(self, name: str):
+        """记录一个处理阶段的耗时，当前请求未选中时不做任何事"""
+        if not self.tracing:
+            return _NULL_STAGE
+        trace = _current_trace.get()
+        if trace is None:
+            return _NULL_STAGE
+        return _Stage(self, trace, name)
+
+    def record(self, name: str, start: float):
+        """记录从start（time.perf_counter()）到现在的阶段耗时"""
+        if not self.tracing:
+            return
+        trace = _current_trace.get()
+        if trace is not None:
+            self._add_event(trace, name, start, time.perf_counter() - start)
+
+    def mark(self, name: str):
+        """记录一个时间点，例如收到第一个数据块"""
+        if not self.tracing:
+            return
+        trace = _current_trace.get()
+        if trace is not None:
+            self._add_event(trace, name, time.perf_counter(), None)
+
+    def _add_event(self, trace: _Trace, name: str, start: float, duration: Optional[float]):
+        event = {
+            "name": name,
+            "ph": "X" if duration is not None else "i",
+            "ts": round((start - self._epoch) * 1e6),
+            "pid": os.getpid(),
+            "tid": trace.tid,
+            "args": {"session_id": trace.session_id},
+        }
+        if duration is not None:
+            event["dur"] = round(duration * 1e6)
+        else:
+            event["s"] = "t"
+        with self._lock:
+            self._trace_events.append(event)
+            if len(self._trace_events) > MAX_TRACE_EVENTS:
+                del self._trace_events[:len(self._trace_events) - MAX_TRACE_EVENTS]
+
+    def chrome_trace(self) -> str:
+        """导出Chrome Trace格式的阶段计时"""
+        with self._lock:
+            events = list(self._trace_events)
+            names = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                 "args": {"name": f"session {sid}"}}
+                for sid, tid in self._trace_tids.items()
+            ]
+        return json.dumps({"traceEvents": names + events, "displayTimeUnit": "ms"}, ensure_ascii=False)
+
+
+class ProfilerMiddleware:
+    """ASGI中间件，分析未开启时直接调用下游应用"""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if not self.profiler.active or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        await self.profiler.handle(self.app, scope, receive, send)
+
+
+# 全局分析器实例
+profiler = RequestProfiler()
@@ -8,6 +8,16 @@ let audioQueue = []; // 用于流式播放的音频队列
 let isAudioPlaying = false; // 表示是否正在播放音频
 let audioContext2 = null; // 用于流式播放的音频上下文
 let sseConnection = null; // 用于流式连接
+let pcmPlayer = null; // AudioWorklet流式播放器
+let pcmRemainder = null; // 跨数据块未配对的PCM字节
+let uploadSession = null; // 当前语音的增量上传会话
+let recentFrames = []; // 最近的VAD音频帧，语音开始时补传
+let vadFramesReceived = false; // VAD是否通过onFrameProcessed提供过音频帧
+
+// 页面会话ID，随请求头X-Session-Id发送，便于服务端按会话进行性能分析
+const clientSessionId = (window.crypto && crypto.randomUUID)
+    ? crypto.randomUUID()
+    : `${Date.now().toString(16)}-${Math.random().toString(16).slice(2)}`;
 
 // API配置
 const apiConfig = {
@@ -15,6 +25,21 @@ const apiConfig = {
     processingEndpoint: '/process_audio',
     streamEndpoint: '/stream_audio', // 新增流式处理端点
     useStream: true, // 默认启用流式处理
+    useWorkletPlayer: true, // 支持AudioWorklet时使用环形缓冲播放器播放原始PCM
+    // 优先使用页面中带指纹的地址，可长期缓存
+    workletUrl: document.querySelector('meta[name="pcm-worklet-url"]')?.content || '/static/js/pcm-player-worklet.js',
+    playbackMetricsEndpoint: '/playback_metrics',
+    outputSampleRate: 24000, // 模型输出音频的采样率
+    useIncrementalUpload: true, // 说话过程中即开始上传音频
+    uploadSessionEndpoint: '/upload_sessions',
+    uploadChunkMs: 250, // 每次上传的音频时长
+    uploadPreRollFrames: 3, // 语音开始时补传的之前的帧数
+    inputSampleRate: 16000, // VAD输出音频的采样率
+    jitterBuffer: {
+        initialTargetMs: 60, // 首次开始播放前缓冲的时长
+        minTargetMs: 40,
+        maxTargetMs: 400
+    },
     debug: true
 };
 
@@ -136,6 +161,17 @@ function writeString(view, offset, string) {
     }
 }
 
+// 将Float32Array转换为16位PCM，与float32ArrayToWav使用相同的音量缩放
+function float32ToInt16(audioData) {
+    const volume = 0.8;
+    const pcm = new Int16Array(audioData.length);
+    for (let i = 0; i < audioData.length; i++) {
+        const sample = Math.max(-1, Math.min(1, audioData[i]));
+        pcm[i] = Math.floor(sample * volume * 32767);
+    }
+    return pcm;
+}
+
 // 更新处理进度状态
 function updateProcessingStatus(stage, progress = null) {
     // 阶段: 'recording', 'processing', 'sending', 'receiving', 'complete'
@@ -236,6 +272,34 @@ async function processAudio(audioData) {
             return;
         }
         
+        // 更新UI状态
+        updateStatus("处理中...", "processing");
+        hideError(); // 清除任何显示的错误
+        
+        // 说话期间已上传的音频直接提交，无需再编码上传
+        const session = takeUploadSession();
+        if (session) {
+            if (apiConfig.useStream !== false) {
+                // 只有提交在开始流式响应之前被拒绝时才改为上传完整音频，
+                // 响应开始后的错误走正常的重试流程，避免重复调用模型
+                try {
+                    const result = await commitUploadSession(session);
+                    if (result) {
+                        return result;
+                    }
+                    addLog("增量上传未完成，改为上传完整音频");
+                } catch (error) {
+                    if (!(error instanceof StreamRejectedError)) {
+                        throw error;
+                    }
+                    addLog(`增量上传提交被拒绝 (${error.status})，改为上传完整音频`);
+                    discardUploadSession(session);
+                }
+            } else {
+                discardUploadSession(session);
+            }
+        }
+        
         // 转换为WAV格式
         const wavBuffer = float32ArrayToWav(audioData, 16000);
         
@@ -243,10 +307,6 @@ async function processAudio(audioData) {
         const blob = new Blob([wavBuffer], { type: 'audio/wav' });
         const base64Audio = await blobToBase64(blob);
         
-        // 更新UI状态
-        updateStatus("处理中...", "processing");
-        hideError(); // 清除任何显示的错误
-        
         // 判断是使用流式请求还是常规请求
         if (apiConfig.useStream !== false) {
             // 使用流式请求
@@ -292,6 +352,24 @@ async function processAudio(audioData) {
 
 // 流式处理音频
 async function streamAudio(base64Audio, audioFormat = 'wav') {
+    return await streamResponse(apiConfig.streamEndpoint, {
+        audio_data: base64Audio,
+        audio_format: audioFormat
+    });
+}
+
+// 流式请求在开始响应之前被服务端拒绝（非2xx状态码）
+class StreamRejectedError extends Error {
+    constructor(status, statusText) {
+        super(`流式请求错误: ${status} ${statusText}`);
+        this.name = 'StreamRejectedError';
+        this.status = status;
+    }
+}
+
+// 发送请求并处理流式响应
+// 服务端拒绝请求时抛出StreamRejectedError，响应开始后出错时返回null
+async function streamResponse(endpoint, payload) {
     try {
         updateStatus("开始流式请求...", "processing");
         
@@ -299,6 +377,10 @@ async function streamAudio(base64Audio, audioFormat = 'wav') {
         audioQueue = [];
         isAudioPlaying = false;
         let accumulatedText = '';
+        const usePCM = pcmPlayer !== null;
+        if (usePCM) {
+            resetPCMPlayer();
+        }
         
         // 清理之前可能存在的连接
         if (sseConnection) {
@@ -310,25 +392,36 @@ async function streamAudio(base64Audio, audioFormat = 'wav') {
         addLog("开始流式音频请求");
         
         // 创建响应读取器
-        const response = await fetch(`${apiConfig.apiUrl}/stream_audio`, {
+        const response = await fetch(`${apiConfig.apiUrl}${endpoint}`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Session-Id': clientSessionId,
             },
             body: JSON.stringify({
-                audio_data: base64Audio,
-                audio_format: audioFormat
+                ...payload,
+                stream_format: usePCM ? 'pcm' : 'wav'
             })
         });
         
         if (!response.ok) {
-            const errorMsg = `流式请求错误: ${response.status} ${response.statusText}`;
-            showError(errorMsg);
-            throw new Error(errorMsg);
+            throw new StreamRejectedError(response.status, response.statusText);
         }
         
-        // 创建一个空的AI回复用于更新
-        addConversation('ai', '');
+        // 创建一个空的AI回复用于更新，文本增量追加到同一个文本节点
+        const textNode = document.createTextNode('');
+        addConversation('ai', '').appendChild(textNode);
+        
+        // 文本增量合并到下一帧统一更新，避免每个事件都触发重排
+        let pendingText = '';
+        let renderScheduled = false;
+        const renderText = () => {
+            renderScheduled = false;
+            if (pendingText) {
+                textNode.appendData(pendingText);
+                pendingText = '';
+            }
+        };
         
         // 获取响应的reader
         const reader = response.body.getReader();
@@ -348,15 +441,13 @@ async function streamAudio(base64Audio, audioFormat = 'wav') {
             const text = decoder.decode(value, { stream: true });
             buffer += text;
             
-            // 处理缓冲区中的每个完整事件
+            // 处理缓冲区中的每个完整事件，只移动读取位置，最后一次性截掉已处理的部分
+            let eventStart = 0;
             let eventEnd = buffer.indexOf('\n\n');
             while (eventEnd !== -1) {
-                const eventText = buffer.substring(0, eventEnd);
-                buffer = buffer.substring(eventEnd + 2);
-                
                 // 处理事件文本
-                if (eventText.startsWith('data: ')) {
-                    const eventData = eventText.substring(6);
+                if (buffer.startsWith('data: ', eventStart)) {
+                    const eventData = buffer.substring(eventStart + 6, eventEnd);
                     try {
                         const data = JSON.parse(eventData);
                         
@@ -365,13 +456,18 @@ async function streamAudio(base64Audio, audioFormat = 'wav') {
                             case 'text':
                                 // 处理文本事件
                                 accumulatedText += data.data;
-                                // 更新UI中的文本
-                                const textElem = document.querySelector('.ai-message:last-child .message-text');
-                                if (textElem) {
-                                    textElem.textContent = accumulatedText;
+                                pendingText += data.data;
+                                if (!renderScheduled) {
+                                    renderScheduled = true;
+                                    requestAnimationFrame(renderText);
                                 }
                                 break;
                                 
+                            case 'pcm':
+                                // 原始PCM直接写入AudioWorklet播放器
+                                pushPCMChunk(data.data);
+                                break;
+                                
                             case 'audio':
                                 // 处理音频事件，添加到队列
                                 audioQueue.push(data.data);
@@ -406,26 +502,204 @@ async function streamAudio(base64Audio, audioFormat = 'wav') {
                 }
                 
                 // 查找下一个事件的结束位置
-                eventEnd = buffer.indexOf('\n\n');
+                eventStart = eventEnd + 2;
+                eventEnd = buffer.indexOf('\n\n', eventStart);
+            }
+            if (eventStart > 0) {
+                buffer = buffer.substring(eventStart);
             }
         }
         
+        // 显示剩余的文本
+        renderText();
+        
+        // 通知播放器数据已全部到达
+        if (usePCM) {
+            endPCMStream();
+        }
+        
         // 更新状态
         updateStatus("流式处理完成", "complete");
         
         // 返回结果
         return {
             text: accumulatedText,
-            audio: null // 已经通过流式播放了
+            audio: null, // 已经通过流式播放了
+            streamed: true // 文本已经显示在对话中
         };
     } catch (error) {
+        if (error instanceof StreamRejectedError) {
+            // 由调用方决定是否改用其他方式重新请求
+            throw error;
+        }
         console.error("流式处理音频出错:", error);
+        if (pcmPlayer) {
+            endPCMStream();
+        }
         showError(`流式处理音频出错: ${error.message}`);
         addLog(`流式处理音频出错: ${error.message}`);
         return null;
     }
 }
 
+// 语音开始时创建增量上传会话
+function startUploadSession() {
+    if (!apiConfig.useIncrementalUpload || !apiConfig.useStream) return;
+    if (uploadSession) {
+        discardUploadSession(uploadSession);
+    }
+    
+    const session = {
+        id: null,
+        frames: [],
+        bufferedSamples: 0,
+        sentSamples: 0,
+        pending: [],
+        failed: false
+    };
+    session.ready = fetch(`${apiConfig.apiUrl}${apiConfig.uploadSessionEndpoint}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'X-Session-Id': clientSessionId,
+        },
+        body: JSON.stringify({ sample_rate: apiConfig.inputSampleRate })
+    }).then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP错误! 状态: ${response.status}`);
+        }
+        return response.json();
+    }).then(result => {
+        session.id = result.session_id;
+        flushUploadFrames(session);
+    }).catch(error => {
+        session.failed = true;
+        addLog(`创建上传会话失败: ${error.message}`);
+    });
+    
+    // 补传语音开始前的几帧
+    recentFrames.forEach(frame => appendUploadFrame(session, frame));
+    uploadSession = session;
+}
+
+// VAD未提供音频帧时关闭增量上传，改为语音结束后上传完整音频
+function disableIncrementalUpload(reason) {
+    if (!apiConfig.useIncrementalUpload) return;
+    apiConfig.useIncrementalUpload = false;
+    console.warn(`增量上传不可用: ${reason}`);
+    addLog(`警告: 增量上传不可用，将在语音结束后上传完整音频 (${reason})`);
+}
+
+// 记录VAD处理过的音频帧
+function handleVADFrame(frame) {
+    if (!(frame instanceof Float32Array)) {
+        // 当前版本的VAD在onFrameProcessed中不提供音频帧
+        disableIncrementalUpload("VAD的onFrameProcessed回调未提供音频帧");
+        return;
+    }
+    vadFramesReceived = true;
+    recentFrames.push(frame);
+    if (recentFrames.length > apiConfig.uploadPreRollFrames) {
+        recentFrames.shift();
+    }
+    if (uploadSession) {
+        appendUploadFrame(uploadSession, frame);
+    }
+}
+
+// 缓存音频帧，累计到一定时长后上传
+function appendUploadFrame(session, frame) {
+    session.frames.push(frame);
+    session.bufferedSamples += frame.length;
+    const chunkSamples = apiConfig.inputSampleRate * apiConfig.uploadChunkMs / 1000;
+    if (session.bufferedSamples >= chunkSamples) {
+        flushUploadFrames(session);
+    }
+}
+
+// 上传已缓存的音频帧
+function flushUploadFrames(session) {
+    if (!session.id || session.failed || session.bufferedSamples === 0) return;
+    
+    // 合并缓存的帧
+    const samples = new Float32Array(session.bufferedSamples);
+    let position = 0;
+    for (const frame of session.frames) {
+        samples.set(frame, position);
+        position += frame.length;
+    }
+    const offset = session.sentSamples;
+    session.sentSamples += samples.length;
+    session.frames = [];
+    session.bufferedSamples = 0;
+    
+    const pcm = float32ToInt16(samples);
+    const request = fetch(`${apiConfig.apiUrl}${apiConfig.uploadSessionEndpoint}/${session.id}/chunks?offset=${offset}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/octet-stream',
+            'X-Session-Id': clientSessionId,
+        },
+        body: pcm.buffer
+    }).then(response => {
+        if (!response.ok) {
+            throw new Error(`HTTP错误! 状态: ${response.status}`);
+        }
+    }).catch(error => {
+        session.failed = true;
+        addLog(`上传音频数据失败: ${error.message}`);
+    });
+    session.pending.push(request);
+}
+
+// 取出当前的上传会话，之后的音频帧不再写入该会话
+function takeUploadSession() {
+    const session = uploadSession;
+    uploadSession = null;
+    return session;
+}
+
+// 丢弃上传会话
+function discardUploadSession(session) {
+    if (session === uploadSession) {
+        uploadSession = null;
+    }
+    session.ready.then(() => {
+        if (session.id) {
+            fetch(`${apiConfig.apiUrl}${apiConfig.uploadSessionEndpoint}/${session.id}`, {
+                method: 'DELETE'
+            }).catch(() => {});
+        }
+    });
+}
+
+// 提交上传会话并处理流式响应
+// 上传未完成、没有提交时返回null；提交被拒绝时抛出StreamRejectedError
+async function commitUploadSession(session) {
+    await session.ready;
+    flushUploadFrames(session);
+    await Promise.all(session.pending);
+    
+    if (session.failed || session.sentSamples === 0) {
+        if (!vadFramesReceived) {
+            // onFrameProcessed从未被调用，说明VAD不支持该回调
+            disableIncrementalUpload("未收到任何VAD音频帧");
+        }
+        discardUploadSession(session);
+        return null;
+    }
+    
+    addLog(`提交增量上传的音频，时长: ${(session.sentSamples / apiConfig.inputSampleRate).toFixed(2)}秒`);
+    const result = await streamResponse(`${apiConfig.uploadSessionEndpoint}/${session.id}/commit`, {
+        total_samples: session.sentSamples
+    });
+    if (!result) {
+        // 流式响应已经开始，服务端已调用模型，不能再改为上传完整音频
+        throw new Error("流式响应处理失败");
+    }
+    return result;
+}
+
 // 播放队列中的下一个音频
 async function playNextInQueue() {
     if (audioQueue.length === 0) {
@@ -495,6 +769,106 @@ async function playStreamAudio(base64Audio) {
     });
 }
 
+// 初始化AudioWorklet流式播放器，不支持时返回null并使用逐块解码播放
+async function initPCMPlayer() {
+    if (!apiConfig.useWorkletPlayer || !window.AudioWorkletNode) {
+        addLog("当前浏览器不支持AudioWorklet，使用逐块解码播放");
+        return null;
+    }
+    
+    try {
+        // 播放上下文使用模型输出的采样率，避免在音频线程中重采样
+        if (!audioContext2) {
+            audioContext2 = new (window.AudioContext || window.webkitAudioContext)({
+                sampleRate: apiConfig.outputSampleRate
+            });
+        }
+        if (audioContext2.state === 'suspended') {
+            await audioContext2.resume();
+        }
+        
+        await audioContext2.audioWorklet.addModule(apiConfig.workletUrl);
+        const node = new AudioWorkletNode(audioContext2, 'pcm-player', {
+            numberOfInputs: 0,
+            outputChannelCount: [1],
+            processorOptions: apiConfig.jitterBuffer
+        });
+        node.connect(audioContext2.destination);
+        
+        node.port.onmessage = (event) => {
+            const msg = event.data;
+            if (msg.type === 'started') {
+                addLog("流式音频开始播放");
+            } else if (msg.type === 'drained') {
+                addLog(`流式音频播放完成，欠载 ${msg.stats.underruns} 次，缓冲目标 ${msg.stats.target_ms}ms`);
+                reportPlaybackMetrics(msg.stats);
+            }
+        };
+        
+        addLog("AudioWorklet流式播放器已初始化");
+        return { node };
+    } catch (error) {
+        console.error("初始化AudioWorklet播放器失败:", error);
+        addLog(`AudioWorklet播放器初始化失败，使用逐块解码播放: ${error.message}`);
+        return null;
+    }
+}
+
+// 开始新的回复前重置播放器
+function resetPCMPlayer() {
+    pcmRemainder = null;
+    pcmPlayer.node.port.postMessage({ type: 'reset' });
+}
+
+// 将base64编码的16位PCM数据转换为Float32并发送给播放器
+function pushPCMChunk(base64Data) {
+    const binaryString = window.atob(base64Data);
+    const offset = pcmRemainder ? 1 : 0;
+    const totalBytes = binaryString.length + offset;
+    const bytes = new Uint8Array(totalBytes);
+    if (pcmRemainder) {
+        bytes[0] = pcmRemainder[0];
+    }
+    for (let i = 0; i < binaryString.length; i++) {
+        bytes[i + offset] = binaryString.charCodeAt(i);
+    }
+    
+    // 奇数字节留到下一个数据块
+    const sampleCount = totalBytes >> 1;
+    pcmRemainder = (totalBytes & 1) ? bytes.slice(totalBytes - 1) : null;
+    if (sampleCount === 0) {
+        return;
+    }
+    
+    const view = new DataView(bytes.buffer);
+    const samples = new Float32Array(sampleCount);
+    for (let i = 0; i < sampleCount; i++) {
+        samples[i] = view.getInt16(i * 2, true) / 32768;
+    }
+    // 转移缓冲区所有权，避免拷贝
+    pcmPlayer.node.port.postMessage({ type: 'push', samples }, [samples.buffer]);
+}
+
+// 通知播放器本次回复的数据已全部发送
+function endPCMStream() {
+    pcmRemainder = null;
+    pcmPlayer.node.port.postMessage({ type: 'end' });
+}
+
+// 上报播放统计到服务器
+function reportPlaybackMetrics(stats) {
+    fetch(`${apiConfig.apiUrl}${apiConfig.playbackMetricsEndpoint}`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(stats),
+        keepalive: true
+    }).catch(error => {
+        console.error("上报播放统计失败:", error);
+    });
+}
+
 // 播放Base64编码的音频
 function playAudio(base64Audio) {
     return new Promise((resolve, reject) => {
@@ -585,14 +959,31 @@ async function initVAD() {
                     updateStatus("正在聆听...", "listening");
                     addLog("检测到语音开始");
                     
+                    // 开始增量上传
+                    startUploadSession();
+                    
                     // 激活波形显示
                     waveBars.forEach(bar => {
                         bar.style.animationPlayState = 'running';
                     });
                 }
             },
+            onFrameProcessed: (probabilities, frame) => {
+                handleVADFrame(frame);
+            },
+            onVADMisfire: () => {
+                // 语音过短，丢弃已上传的数据
+                if (uploadSession) {
+                    discardUploadSession(uploadSession);
+                }
+            },
             onSpeechEnd: async (audio) => {
-                if (isProcessing || isVADPaused) return;
+                if (isProcessing || isVADPaused) {
+                    if (uploadSession) {
+                        discardUploadSession(uploadSession);
+                    }
+                    return;
+                }
                 isProcessing = true;
                 updateProcessingStatus('recording');
                 addLog("检测到语音结束");
@@ -649,8 +1040,10 @@ async function initVAD() {
                         // 隐藏正在输入指示器
                         hideTypingIndicator();
                         
-                        // 添加AI响应到对话
-                        addConversation('ai', result.text);
+                        // 添加AI响应到对话（流式响应已实时显示）
+                        if (!result.streamed) {
+                            addConversation('ai', result.text);
+                        }
                         
                         // 如果有音频响应，播放它
                         if (result.audio) {
@@ -899,6 +1292,11 @@ async function startConversation() {
             window.speechSynthesis.speak(utterance);
         }
         
+        // 初始化流式播放器（需要在用户交互中创建音频上下文）
+        if (!pcmPlayer) {
+            pcmPlayer = await initPCMPlayer();
+        }
+        
         // 初始化状态显示
         updateProcessingStatus('initializing');
         
@@ -910,6 +1308,8 @@ async function startConversation() {
         document.getElementById('stopBtn').disabled = false;
         updateProcessingStatus('listening');
         
+        addLog(`会话ID: ${clientSessionId}`);
+        
         // 添加欢迎消息
         addConversation('ai', '您好！我是智能语音助手，请开始说话...');
     } catch (error) {
@@ -940,6 +1340,12 @@ async function stopConversation() {
             addLog("音频上下文已关闭");
         }
         
+        // 丢弃未提交的上传会话
+        if (uploadSession) {
+            discardUploadSession(uploadSession);
+        }
+        recentFrames = [];
+        
         // 重置状态
         myvad = null;
         audioContext = null;
@@ -1011,12 +1417,15 @@ function addConversation(speaker, message) {
     senderDiv.textContent = speaker === 'user' ? '你说' : 'AI助手';
     
     const textDiv = document.createElement('div');
+    textDiv.className = 'message-text';
     textDiv.textContent = message;
     
     messageDiv.appendChild(senderDiv);
     messageDiv.appendChild(textDiv);
     conversationContent.appendChild(messageDiv);
     conversationContent.scrollTop = conversationContent.scrollHeight;
+    
+    return textDiv;
 }
 
 // 页面卸载时清理
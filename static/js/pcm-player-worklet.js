@@ -0,0 +1,193 @@
+// 流式PCM播放器（AudioWorklet）
+// 主线程通过port发送Float32 PCM数据，写入环形缓冲区，
+// 在音频渲染线程中连续读取播放，避免逐块解码和块间空隙。
+// 使用自适应的抖动缓冲目标：发生欠载时增大目标，长时间稳定播放后逐步减小。
+
+class PCMPlayerProcessor extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        const opts = (options && options.processorOptions) || {};
+
+        // 抖动缓冲参数（毫秒）
+        this.minTargetMs = opts.minTargetMs || 40;
+        this.maxTargetMs = opts.maxTargetMs || 400;
+        this.targetMs = opts.initialTargetMs || 60;
+        // 连续稳定播放多久后减小缓冲目标
+        this.stableShrinkMs = opts.stableShrinkMs || 3000;
+
+        // 环形缓冲区，初始容量为10秒，写满时在消息处理中扩容
+        this.capacity = sampleRate * 10;
+        this.ring = new Float32Array(this.capacity);
+        this.readIndex = 0;
+        this.writeIndex = 0;
+        this.available = 0;
+
+        // 播放状态: 'idle' 等待数据, 'buffering' 缓冲中, 'playing' 播放中
+        this.state = 'idle';
+        this.ended = false;
+        this.stableSamples = 0;
+
+        // 统计信息
+        this.resetStats();
+
+        this.port.onmessage = (event) => this.handleMessage(event.data);
+    }
+
+    resetStats() {
+        this.stats = {
+            underruns: 0,
+            underrunSamples: 0,
+            playedSamples: 0,
+            maxBufferedSamples: 0,
+            startDelaySamples: 0
+        };
+        this.startFrame = null;
+    }
+
+    handleMessage(msg) {
+        switch (msg.type) {
+            case 'push':
+                this.write(msg.samples);
+                break;
+            case 'end':
+                // 数据已全部发送，剩余数据不足缓冲目标时也直接播放
+                this.ended = true;
+                break;
+            case 'reset':
+                // 开始新的回复
+                this.readIndex = 0;
+                this.writeIndex = 0;
+                this.available = 0;
+                this.state = 'idle';
+                this.ended = false;
+                this.stableSamples = 0;
+                this.resetStats();
+                break;
+        }
+    }
+
+    write(samples) {
+        if (this.available + samples.length > this.capacity) {
+            this.grow(this.available + samples.length);
+        }
+
+        // 分两段写入环形缓冲区
+        const first = Math.min(samples.length, this.capacity - this.writeIndex);
+        this.ring.set(samples.subarray(0, first), this.writeIndex);
+        if (first < samples.length) {
+            this.ring.set(samples.subarray(first), 0);
+        }
+        this.writeIndex = (this.writeIndex + samples.length) % this.capacity;
+        this.available += samples.length;
+
+        if (this.available > this.stats.maxBufferedSamples) {
+            this.stats.maxBufferedSamples = this.available;
+        }
+        if (this.state === 'idle') {
+            this.state = 'buffering';
+            this.startFrame = currentFrame;
+        }
+    }
+
+    grow(required) {
+        let capacity = this.capacity * 2;
+        while (capacity < required) {
+            capacity *= 2;
+        }
+        const ring = new Float32Array(capacity);
+        // 按顺序拷贝已有数据
+        for (let i = 0; i < this.available; i++) {
+            ring[i] = this.ring[(this.readIndex + i) % this.capacity];
+        }
+        this.ring = ring;
+        this.capacity = capacity;
+        this.readIndex = 0;
+        this.writeIndex = this.available;
+    }
+
+    targetSamples() {
+        return Math.round(this.targetMs * sampleRate / 1000);
+    }
+
+    process(inputs, outputs) {
+        const output = outputs[0];
+        const channel = output[0];
+        const frames = channel.length;
+
+        if (this.state === 'buffering') {
+            // 缓冲达到目标，或数据已结束，开始播放
+            if (this.available >= this.targetSamples() || (this.ended && this.available > 0)) {
+                if (this.stats.playedSamples === 0 && this.startFrame !== null) {
+                    this.stats.startDelaySamples = currentFrame - this.startFrame;
+                    this.port.postMessage({ type: 'started' });
+                }
+                this.state = 'playing';
+            } else if (this.ended && this.available === 0) {
+                // 欠载后数据已结束，没有剩余数据可播放
+                this.state = 'idle';
+                this.port.postMessage({ type: 'drained', stats: this.report() });
+            }
+        }
+
+        let written = 0;
+        if (this.state === 'playing') {
+            written = Math.min(frames, this.available);
+            const first = Math.min(written, this.capacity - this.readIndex);
+            channel.set(this.ring.subarray(this.readIndex, this.readIndex + first), 0);
+            if (first < written) {
+                channel.set(this.ring.subarray(0, written - first), first);
+            }
+            this.readIndex = (this.readIndex + written) % this.capacity;
+            this.available -= written;
+            this.stats.playedSamples += written;
+            this.stableSamples += written;
+
+            // 长时间稳定播放，逐步减小缓冲目标以降低延迟
+            if (this.stableSamples >= this.stableShrinkMs * sampleRate / 1000) {
+                this.targetMs = Math.max(this.minTargetMs, this.targetMs * 0.9);
+                this.stableSamples = 0;
+            }
+
+            if (written < frames) {
+                if (this.ended) {
+                    // 正常播放完毕
+                    this.state = 'idle';
+                    this.port.postMessage({ type: 'drained', stats: this.report() });
+                } else {
+                    // 欠载：增大缓冲目标并重新缓冲
+                    this.stats.underruns++;
+                    this.stats.underrunSamples += frames - written;
+                    this.targetMs = Math.min(this.maxTargetMs, this.targetMs * 1.5);
+                    this.stableSamples = 0;
+                    this.state = 'buffering';
+                }
+            }
+        } else if (this.state === 'buffering' && this.stats.playedSamples > 0) {
+            // 欠载后的等待时间也计入欠载时长
+            this.stats.underrunSamples += frames;
+        }
+
+        // 未写入的部分填充静音
+        if (written < frames) {
+            channel.fill(0, written);
+        }
+        for (let c = 1; c < output.length; c++) {
+            output[c].set(channel);
+        }
+        return true;
+    }
+
+    report() {
+        const toMs = (samples) => Math.round(samples * 1000 / sampleRate);
+        return {
+            underruns: this.stats.underruns,
+            underrun_ms: toMs(this.stats.underrunSamples),
+            played_ms: toMs(this.stats.playedSamples),
+            max_buffered_ms: toMs(this.stats.maxBufferedSamples),
+            start_delay_ms: toMs(this.stats.startDelaySamples),
+            target_ms: Math.round(this.targetMs)
+        };
+    }
+}
+
+registerProcessor('pcm-player', PCMPlayerProcessor);
@@ -0,0 +1,205 @@
+import os
+import re
+import gzip
+import hashlib
+import mimetypes
+import logging
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+# brotli为可选依赖，未安装时只生成gzip版本
+try:
+    import brotli
+except ImportError:  # pragma: no cover - 取决于运行环境
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# 带指纹的资源内容不会改变，可以长期缓存
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# 入口页面每次都需要重新验证，保证能拿到最新的资源指纹
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# 需要预压缩的文本类资源
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "image/svg+xml",
+)
+
+# 小于该大小的文件压缩收益很小，直接返回原始内容
+MIN_COMPRESS_SIZE = 256
+
+
+class StaticAsset:
+    """单个静态资源，包含原始内容和预压缩版本"""
+
+    def __init__(self, rel_path: str, content: bytes, fingerprint: str, media_type: str):
+        self.rel_path = rel_path
+        self.content = content
+        self.fingerprint = fingerprint
+        self.media_type = media_type
+        self.etag = f'"{fingerprint}"'
+        # 编码 -> 压缩后的内容，只保存比原始内容更小的版本
+        self.encoded: Dict[str, bytes] = {}
+
+    def precompress(self):
+        """生成gzip和brotli压缩版本"""
+        if len(self.content) < MIN_COMPRESS_SIZE or not self.media_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        # mtime固定为0，保证同样的内容生成同样的压缩结果
+        gz = gzip.compress(self.content, compresslevel=9, mtime=0)
+        if len(gz) < len(self.content):
+            self.encoded["gzip"] = gz
+        if brotli is not None:
+            br = brotli.compress(self.content, quality=11)
+            if len(br) < len(self.content):
+                self.encoded["br"] = br
+
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    """解析Accept-Encoding请求头，返回客户端可接受的编码集合"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        # 忽略q=0的编码
+        q = params.strip().replace(" ", "")
+        if q.startswith("q=") and q[2:] in ("0", "0.0", "0.00", "0.000"):
+            continue
+        accepted.add(token)
+    return accepted
+
+
+class StaticAssetPipeline:
+    """静态资源处理管线
+
+    启动时扫描静态目录，为每个文件计算内容指纹并生成gzip/brotli预压缩版本，
+    带指纹的资源通过``/assets/``路径以immutable方式长期缓存。
+    入口页面中对``/static/``资源的引用会被改写为带指纹的地址，
+    入口页面本身直接在``/``返回，避免一次重定向。
+    """
+
+    def __init__(self, directory: str = "static", static_prefix: str = "/static",
+                 assets_prefix: str = "/assets", index_file: str = "index.html"):
+        self.directory = directory
+        self.static_prefix = static_prefix.rstrip("/")
+        self.assets_prefix = assets_prefix.rstrip("/")
+        self.index_file = index_file
+        # 带指纹的相对路径 -> 资源
+        self.assets: Dict[str, StaticAsset] = {}
+        # 原始相对路径 -> 带指纹的URL
+        self.manifest: Dict[str, str] = {}
+        self.index: Optional[StaticAsset] = None
+
+    @staticmethod
+    def _fingerprinted_name(rel_path: str, fingerprint: str) -> str:
+        """在文件扩展名前插入指纹，例如 js/app.js -> js/app.1a2b3c4d.js"""
+        root, ext = os.path.splitext(rel_path)
+        return f"{root}.{fingerprint[:12]}{ext}"
+
+    def build(self):
+        """扫描静态目录，生成指纹、预压缩版本和入口页面"""
+        self.assets.clear()
+        self.manifest.clear()
+        index_path = None
+
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in sorted(filenames):
+                full_path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                if rel_path == self.index_file:
+                    index_path = full_path
+                    continue
+                with open(full_path, "rb") as f:
+                    content = f.read()
+                fingerprint = hashlib.sha256(content).hexdigest()
+                media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                asset = StaticAsset(rel_path, content, fingerprint, media_type)
+                asset.precompress()
+                hashed_name = self._fingerprinted_name(rel_path, fingerprint)
+                self.assets[hashed_name] = asset
+                self.manifest[rel_path] = f"{self.assets_prefix}/{hashed_name}"
+
+        if index_path:
+            with open(index_path, "rb") as f:
+                html = f.read().decode("utf-8")
+            content = self._rewrite_references(html).encode("utf-8")
+            self.index = StaticAsset(
+                self.index_file, content, hashlib.sha256(content).hexdigest(), "text/html"
+            )
+            self.index.precompress()
+
+        logger.info(
+            f"静态资源处理完成: {len(self.assets)} 个文件，"
+            f"brotli{'已启用' if brotli is not None else '未安装，仅使用gzip'}"
+        )
+
+    def _rewrite_references(self, text: str) -> str:
+        """将文本中对/static/资源的引用替换为带指纹的地址"""
+        if not self.manifest:
+            return text
+        # 按路径长度倒序匹配，避免短路径抢先匹配长路径的前缀
+        paths = sorted(self.manifest, key=len, reverse=True)
+        pattern = re.compile(
+            re.escape(self.static_prefix + "/") + "(" + "|".join(re.escape(p) for p in paths) + ")"
+            + r"(?=[\"'\s)?#])"
+        )
+        return pattern.sub(lambda m: self.manifest[m.group(1)], text)
+
+    def url_for(self, rel_path: str) -> str:
+        """返回资源的带指纹地址，未知资源返回原始静态地址"""
+        return self.manifest.get(rel_path, f"{self.static_prefix}/{rel_path}")
+
+    def get(self, hashed_path: str) -> Optional[StaticAsset]:
+        """根据带指纹的相对路径查找资源"""
+        return self.assets.get(hashed_path)
+
+    @staticmethod
+    def response(request: Request, asset: StaticAsset, cache_control: str) -> Response:
+        """根据请求头选择合适的编码，构建资源响应
+
+        Args:
+            request: 当前请求
+            asset: 要返回的资源
+            cache_control: Cache-Control响应头
+
+        Returns:
+            资源响应，命中ETag时返回304
+        """
+        headers = {
+            "Cache-Control": cache_control,
+            "ETag": asset.etag,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if asset.etag in (tag.strip() for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+
+        body = asset.content
+        if asset.encoded:
+            accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+            for encoding in ("br", "gzip"):
+                if encoding in accepted and encoding in asset.encoded:
+                    body = asset.encoded[encoding]
+                    headers["Content-Encoding"] = encoding
+                    break
+
+        return Response(content=body, media_type=asset.media_type, headers=headers)
+
+
+if __name__ == "__main__":
+    # 构建时检查：输出资源清单和压缩效果
+    logging.basicConfig(level=logging.INFO)
+    pipeline = StaticAssetPipeline()
+    pipeline.build()
+    for rel_path, url in sorted(pipeline.manifest.items()):
+        asset = pipeline.get(url[len(pipeline.assets_prefix) + 1:])
+        sizes = ", ".join(f"{enc}: {len(data)}" for enc, data in sorted(asset.encoded.items()))
+        print(f"{rel_path} -> {url} (原始: {len(asset.content)}{', ' + sizes if sizes else ''})")
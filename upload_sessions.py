@@ -0,0 +1,173 @@
+import time
+import uuid
+import bisect
+import threading
+from typing import Dict, List, Optional
+
+# 上传的音频为16位单声道PCM
+BYTES_PER_SAMPLE = 2
+# 支持的上传采样率
+SUPPORTED_SAMPLE_RATES = (16000, 24000, 48000)
+# 单个会话允许的最长音频时长（秒）
+DEFAULT_MAX_SECONDS = 60
+# 会话在最后一次写入后的存活时间（秒）
+DEFAULT_SESSION_TTL = 120
+
+
+class UploadSessionError(Exception):
+    """上传会话操作失败，status_code为对应的HTTP状态码"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadSession:
+    """单次语音的增量上传会话
+
+    创建时按最长时长预分配PCM缓冲区，客户端在说话过程中按采样偏移写入数据，
+    提交时直接取出已完成上传的音频，无需再等待整段音频上传。
+    """
+
+    def __init__(self, session_id: str, sample_rate: int, max_seconds: int):
+        self.session_id = session_id
+        self.sample_rate = sample_rate
+        self.max_samples = sample_rate * max_seconds
+        # 预分配缓冲区，避免上传过程中反复扩容
+        self.buffer = bytearray(self.max_samples * BYTES_PER_SAMPLE)
+        # 已写入的最大采样位置和累计写入的采样数
+        self.num_samples = 0
+        self.received_samples = 0
+        # 已写入的采样区间[start, end)，按起点排序且互不相邻
+        self._ranges: List[List[int]] = []
+        self.chunks = 0
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    def write(self, offset: int, data: bytes):
+        """在指定的采样偏移处写入PCM数据
+
+        Args:
+            offset: 起始采样偏移
+            data: 16位PCM数据
+        """
+        if len(data) % BYTES_PER_SAMPLE:
+            raise UploadSessionError("PCM数据长度必须是2字节的整数倍")
+        samples = len(data) // BYTES_PER_SAMPLE
+        if offset < 0 or offset + samples > self.max_samples:
+            raise self.too_long_error()
+
+        start = offset * BYTES_PER_SAMPLE
+        self.buffer[start:start + len(data)] = data
+        self.num_samples = max(self.num_samples, offset + samples)
+        self.received_samples += samples
+        if samples:
+            self._add_range(offset, offset + samples)
+        self.chunks += 1
+        self.updated_at = time.time()
+
+    def max_chunk_bytes(self, offset: int) -> int:
+        """从offset开始最多还能写入的字节数，用于在读取请求体前限制大小"""
+        if offset < 0:
+            return 0
+        return max(0, self.max_samples - offset) * BYTES_PER_SAMPLE
+
+    def too_long_error(self) -> UploadSessionError:
+        return UploadSessionError(
+            f"音频超出会话允许的最长时长: {self.max_samples // self.sample_rate}秒", status_code=413
+        )
+
+    def _add_range(self, start: int, end: int):
+        """记录已写入的区间，与重叠或相邻的区间合并"""
+        index = bisect.bisect_left(self._ranges, [start, start])
+        # 与前一个区间重叠或相邻时从前一个区间开始合并
+        if index > 0 and self._ranges[index - 1][1] >= start:
+            index -= 1
+        merge_end = index
+        while merge_end < len(self._ranges) and self._ranges[merge_end][0] <= end:
+            start = min(start, self._ranges[merge_end][0])
+            end = max(end, self._ranges[merge_end][1])
+            merge_end += 1
+        self._ranges[index:merge_end] = [[start, end]]
+
+    def is_complete(self) -> bool:
+        """从0到最大采样位置的数据是否全部写入"""
+        return self._ranges == [[0, self.num_samples]]
+
+    def pcm(self, total_samples: Optional[int] = None) -> bytes:
+        """取出已上传的PCM数据
+
+        Args:
+            total_samples: 客户端声明的总采样数，用于校验数据是否完整
+
+        Returns:
+            已上传的PCM数据
+        """
+        if self.num_samples == 0:
+            raise UploadSessionError("会话中没有音频数据")
+        if not self.is_complete() or (total_samples is not None and total_samples != self.num_samples):
+            covered = sum(end - start for start, end in self._ranges)
+            raise UploadSessionError(
+                f"音频数据不完整: 已收到 {covered} 个采样（最大位置 {self.num_samples}），"
+                f"预期 {total_samples if total_samples is not None else self.num_samples} 个",
+                status_code=409
+            )
+        return bytes(memoryview(self.buffer)[:self.num_samples * BYTES_PER_SAMPLE])
+
+
+class UploadSessionManager:
+    """管理进行中的上传会话，过期会话在创建新会话时清理"""
+
+    def __init__(self, max_seconds: int = DEFAULT_MAX_SECONDS, ttl: int = DEFAULT_SESSION_TTL,
+                 max_sessions: int = 100):
+        self.max_seconds = max_seconds
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+
+    def _cleanup(self):
+        """清理过期会话，调用方需持有锁"""
+        now = time.time()
+        expired = [sid for sid, s in self._sessions.items() if now - s.updated_at > self.ttl]
+        for sid in expired:
+            del self._sessions[sid]
+
+    def create(self, sample_rate: int = 16000, max_seconds: Optional[int] = None) -> UploadSession:
+        """创建新的上传会话"""
+        if sample_rate not in SUPPORTED_SAMPLE_RATES:
+            raise UploadSessionError(
+                f"不支持的采样率: {sample_rate}，支持: {', '.join(map(str, SUPPORTED_SAMPLE_RATES))}"
+            )
+        if max_seconds is None:
+            max_seconds = self.max_seconds
+        elif max_seconds < 1:
+            raise UploadSessionError("max_seconds必须大于等于1")
+        max_seconds = min(max_seconds, self.max_seconds)
+        with self._lock:
+            self._cleanup()
+            if len(self._sessions) >= self.max_sessions:
+                raise UploadSessionError("上传会话数量过多，请稍后再试", status_code=429)
+            session = UploadSession(uuid.uuid4().hex, sample_rate, max_seconds)
+            self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id: str) -> UploadSession:
+        """获取上传会话，不存在时抛出异常"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise UploadSessionError("上传会话不存在或已过期", status_code=404)
+        return session
+
+    def pop(self, session_id: str) -> UploadSession:
+        """移除并返回上传会话"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise UploadSessionError("上传会话不存在或已过期", status_code=404)
+        return session
+
+
+# 全局会话管理器
+upload_sessions = UploadSessionManager()